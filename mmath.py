@@ -17,38 +17,46 @@
 # You should have received a copy of the GNU General Public License
 # along with this program; if not see <http://www.gnu.org/licenses/>   
 
-from collections import defaultdict
-from functools import reduce
-from math import gcd, sqrt
+from collections import Counter
+from functools import lru_cache, reduce
+from itertools import islice
+from math import gcd, isqrt
 from operator import mul
 
+# non std modules
+try:
+    import numpy as np
+    HAS_NUMPY = True
+except ImportError:
+    HAS_NUMPY = False
+try:
+    import gmpy2
+    HAS_GMPY2 = True
+except ImportError:
+    HAS_GMPY2 = False
+
 
 def avg (seq):
     """Get the average of $seq"""
-    tot = 0
+    if hasattr(seq, '__len__'):
+        n = len(seq)
+        return sum(seq) / n if n else 0
+    tot = n = 0
     for n, v in enumerate(seq, 1):
         tot += v
-    try:
-        return tot / n
-    except UnboundLocalError:
-        return 0
+    return tot / n if n else 0
 
 
 def dec2bin(n):
     """return a bit-string representation of *n*."""
-    b = [str(n & 1)]
-    while (n := n >> 1):
-        b.append(str(n & 1))
-    return ''.join(map(str, reversed(b)))
+    return format(n, 'b')
 
 
 def decimal_threshold (n, precision=4):
     """To consider equal a number $n and its
     integral value under a certain $precision."""
-    exp = 10 ** precision
     n = abs(n)
-    r =  (n - int(n)) * exp
-    return True if (n - int(n)) * exp < 1 else False
+    return n - int(n) < 10 ** -precision
 
 
 def eqd (a, b, delta, precision=4):
@@ -66,14 +74,55 @@ def eqd (a, b, delta, precision=4):
     return (abs((a - b) * exp) <= abs(delta * exp)) 
 
 
+_SMALL_PRIMES = (3, 5, 7, 11, 13, 17, 19, 23, 29, 31, 37, 41, 43,
+                 47, 53, 59, 61, 67, 71, 73, 79, 83, 89, 97)
+_SMALL_PRIMES_SET = frozenset((2,) + _SMALL_PRIMES)
+
+# deterministic Miller-Rabin witnesses for n < _MR_LIMIT
+_MR_WITNESSES = (2, 3, 5, 7, 11, 13, 17, 19, 23, 29, 31, 37, 41)
+_MR_LIMIT = 3317044064679887385961981
+_powmod = gmpy2.powmod if HAS_GMPY2 else pow
+
+def _miller_rabin (n, a, powmod=_powmod):
+    """
+    Return False if *a* is a witness for the compositeness of
+    the odd number *n*, True if *n* is a strong probable prime to base *a*.
+    *powmod* is the modular exponentiation function (default to
+    gmpy2.powmod if available, pow otherwise).
+    """
+    d = n - 1
+    s = (d & -d).bit_length() - 1
+    d >>= s
+    x = powmod(a, d, n)
+    if x == 1 or x == n - 1:
+        return True
+    for _ in range(s - 1):
+        x = powmod(x, 2, n)
+        if x == n - 1:
+            return True
+    return False
+
+
+@lru_cache(maxsize=100000)
 def is_prime (x):
-    """Return True if *x* is a prime number, False otherwise."""
-    if x < 2 or (x != 2 and not x % 2):
+    """Return True if *x* is a prime number, False otherwise.
+    For *x* >= _MR_LIMIT uses gmpy2's probabilistic test if available,
+    falling back to (slow) trial division otherwise."""
+    if x < 2 or (x != 2 and not x & 1):
         return False
-    elif x in (2, 3, 5, 7):
+    elif x in _SMALL_PRIMES_SET:
+        return True
+    for p in _SMALL_PRIMES:
+        if not x % p:
+            return False
+    if x < 10201: # 101**2
         return True
-    a = 3
-    limit = sqrt(x)
+    if x < _MR_LIMIT:
+        return all(_miller_rabin(x, a) for a in _MR_WITNESSES)
+    if HAS_GMPY2:
+        return bool(gmpy2.is_prime(gmpy2.mpz(x), 25))
+    a = 101
+    limit = isqrt(x)
     while a <= limit:
         if not (x % a):
             return False
@@ -81,10 +130,13 @@ def is_prime (x):
     return True
 
 
-def primes_from (n):
-    """Yield primes biggers than *n*."""
+def _primes_from_is_prime (n):
+    """Yield primes biggers than *n*, testing each odd candidate."""
     n += 1
-    if not n % 2:
+    if n <= 2:
+        yield 2
+        n = 3
+    elif not n & 1:
         n += 1
     while True:
         if is_prime(n):
@@ -92,9 +144,55 @@ def primes_from (n):
         n += 2
 
 
+# segmented sieve parameters for primes_from
+_SIEVE_SEGSIZE = 2 ** 16
+_SIEVE_LIMIT = 2 ** 32
+
+@lru_cache(maxsize=1)
+def _sieve_base_primes (n):
+    """Return a tuple of the primes <= *n* (Sieve of Eratosthenes)."""
+    sieve = np.ones(n + 1, dtype=bool)
+    sieve[:2] = False
+    for i in range(2, isqrt(n) + 1):
+        if sieve[i]:
+            sieve[i*i::i] = False
+    return tuple(np.flatnonzero(sieve).tolist())
+
+
+def _primes_from_sieve (start, stop):
+    """
+    Yield primes in the range [*start*, *stop*) using a segmented
+    sieve of Eratosthenes (*stop* must be <= _SIEVE_LIMIT).
+    """
+    base_primes = _sieve_base_primes(isqrt(_SIEVE_LIMIT))
+    for low in range(start, stop, _SIEVE_SEGSIZE):
+        high = min(low + _SIEVE_SEGSIZE, stop)
+        segment = np.ones(high - low, dtype=bool)
+        if low < 2:
+            segment[:2-low] = False
+        for p in base_primes:
+            if p * p >= high:
+                break
+            segment[max(p * p, -(-low // p) * p) - low::p] = False
+        yield from (np.flatnonzero(segment) + low).tolist()
+
+
+def primes_from (n):
+    """
+    Yield primes biggers than *n*.
+    Uses a segmented sieve up to _SIEVE_LIMIT when numpy is
+    available (faster when pulling many primes), is_prime otherwise.
+    """
+    n = max(n + 1, 0)
+    if HAS_NUMPY and n < _SIEVE_LIMIT:
+        yield from _primes_from_sieve(n, _SIEVE_LIMIT)
+        n = _SIEVE_LIMIT
+    yield from _primes_from_is_prime(n - 1)
+
+
 def next_prime (n):
     """Return the first prime number bigger than *n*."""
-    return next(primes_from(n))
+    return next(_primes_from_is_prime(n))
 
 
 def perc (value, perc, fun=lambda n:n):
@@ -109,9 +207,11 @@ def perc (value, perc, fun=lambda n:n):
     return fun(x)
 
 
-def in_perc_range (num, value, perc_value, fun=lambda n:n):
+def in_perc_range (num, value, perc_value, fun=None):
     """
     Returns True if $num is in the ±$perc_value range of $value.
+    $fun, if given, is applied to the ±range amount (see perc).
+    The range is symmetric also for negative $value.
     >>> in_perc_range(110, 100, 10)
     True
     >>> in_perc_range(111, 100, 10)
@@ -121,64 +221,71 @@ def in_perc_range (num, value, perc_value, fun=lambda n:n):
     >>> in_perc_range(89, 100, 10)
     False
     """
-    x = perc(value, perc_value, fun)
-    return num >= (value - x) and num <= (value + x)
+    if fun is None:
+        x = perc_value * abs(value) / 100
+    else:
+        x = perc(abs(value), perc_value, fun)
+    return (value - x) <= num <= (value + x)
 
 
-def prime_factors (n):
-    """Return a list of prime factors of *n*."""
-    lst = []
-    actual = 2
-    limit = int(sqrt(n))
+_WHEEL_INC = (4, 2, 4, 2, 4, 6, 2, 6)
+
+def _wheel_factors (n):
+    """
+    Yields the prime factors of *n* (in ascending order),
+    using a 2-3-5 wheel for the trial divisions.
+    """
+    for p in (2, 3, 5):
+        while n > 1 and not n % p:
+            n //= p
+            yield p
+    actual = 7
+    i = 0
+    limit = isqrt(n)
     while actual <= limit:
         if not n % actual:
             n //= actual
-            limit = sqrt(n)
-            lst.append(actual)
+            limit = isqrt(n)
+            yield actual
         else:
-            actual += 1 + actual % 2
+            actual += _WHEEL_INC[i & 7]
+            i += 1
     if n > 1:
-        lst.append(n)
-    return lst
+        yield n
+
+
+def prime_factors (n):
+    """Return a list of prime factors of *n*."""
+    return list(_wheel_factors(n))
 
 
 def prime_factors_dict (n):
     """
     Return the prime factors of *n* as a dict of base:exp items.
     """
-    factors = defaultdict(int)
-    actual = 2
-    limit = int(sqrt(n))
-    while actual <= limit:
-        if not n % actual:
-            n //= actual
-            limit = sqrt(n)
-            factors[actual] += 1
-        else:
-            actual += 1 + actual % 2
-    if n > 1:
-        factors[n] += 1
-    return factors
+    return Counter(prime_factors_i(n))
 
 
 def prime_factors_i (num):
     """ Yields the prime factors of *num*."""
-    num = num
-    actual = 2
-    limit = int(sqrt(num))
-    while actual <= limit:
-        if not num % actual:
-            num //= actual
-            limit = sqrt(num)
-            yield actual
-        else:
-            actual += 1 + (actual % 2)
-    if num > 1:
-        yield num
+    yield from _wheel_factors(num)
 
 
 def totient (n):
-    """Return the Euler's totient of *n*."""
+    """Return the Euler's totient of *n* (using Euler's product formula)."""
+    if n < 1:
+        return 0
+    result = n
+    for p in prime_factors_dict(n):
+        result -= result // p
+    return result
+
+
+def totient_naive (n):
+    """Return the Euler's totient of *n*, counting the coprimes."""
+    if HAS_NUMPY:
+        return int(np.count_nonzero(
+            np.gcd(np.arange(1, n+1, dtype=np.int64), n) == 1))
     return sum(1 for x in range(1, n+1) if gcd(x, n) == 1)
 
 
@@ -187,24 +294,78 @@ def totient_pairs (n):
     return list((x, n) for x in range(1, n+1) if gcd(x, n) == 1)
 
 
+def totient_pairs_soa (n):
+    """
+    Like totient_pairs, but return a (coprimes, n) pair, where
+    coprimes are the x values (a numpy array when available, otherwise
+    a list) and n is shared by all of them.
+    """
+    if HAS_NUMPY:
+        xs = np.arange(1, n+1, dtype=np.int64)
+        return xs[np.gcd(xs, n) == 1], n
+    return [x for x in range(1, n+1) if gcd(x, n) == 1], n
+
+
 ###################### TODO: tests
 
 def _test_avg():
+    from decimal import Decimal
+    from fractions import Fraction
     assert avg([]) == 0, f'FAIL: avg([])'
     assert avg([0]) == 0, f'FAIL: avg([0])'
     assert avg([1]) == 1, f'FAIL: avg([1])'
     assert avg([0, 10]) == 5, f'FAIL: avg([0, 10])'
+    assert avg(iter([])) == 0, f'FAIL: avg(iter([]))'
+    assert avg(x for x in (0, 10)) == 5, f'FAIL: avg(x for x in (0, 10))'
+    assert (avg(iter([Decimal('1.1'), Decimal('2.2')])) == Decimal('1.65')
+            ), f'FAIL: avg(iter([Decimal(1.1), Decimal(2.2)]))'
+    assert (avg(iter([Fraction(1, 3), Fraction(1, 6)])) == Fraction(1, 4)
+            ), f'FAIL: avg(iter([Fraction(1, 3), Fraction(1, 6)]))'
+    assert (avg([Decimal('1.1'), Decimal('2.2')]) == Decimal('1.65')
+            ), f'FAIL: avg([Decimal(1.1), Decimal(2.2)])'
+    assert (avg((Fraction(1, 3), Fraction(1, 6))) == Fraction(1, 4)
+            ), f'FAIL: avg((Fraction(1, 3), Fraction(1, 6)))'
     return True
 
 def _test_primes():
     for i in range(2, 100000):
         factors = prime_factors(i)
-        assert (reduce(mul, factors)
-                == reduce(mul, (k**v for k, v in prime_factors_dict(i).items()))
-                == reduce(mul, prime_factors(i))), f'FAIL [factors]: {i}'
+        assert (i == reduce(mul, factors)
+                == reduce(mul, (k**v for k, v in Counter(factors).items()))
+                ), f'FAIL [factors]: {i}'
+        assert prime_factors_dict(i) == Counter(factors), f'FAIL: prime_factors_dict({i})'
+        assert list(prime_factors_i(i)) == factors, f'FAIL: prime_factors_i({i})'
         for f in factors:
             assert is_prime(f) == True, f'FAIL: is_prime({f})'
             assert is_prime(f + 7) == False, f'FAIL: is_prime({f+7})'
+    for n in (-10, 0, 1, 2, _SIEVE_SEGSIZE - 100, _SIEVE_LIMIT - 1000):
+        expected = list(islice(_primes_from_is_prime(n), 500))
+        assert list(islice(primes_from(n), 500)) == expected, f'FAIL: primes_from({n})'
+        assert next_prime(n) == expected[0], f'FAIL: next_prime({n})'
+    # strong pseudoprimes to the first 4, 6, 9 and 12 primes
+    for n in (3215031751, 3474749660383, 3825123056546413051,
+              318665857834031151167461):
+        assert is_prime(n) == False, f'FAIL: is_prime({n})'
+    for n in (2**61 - 1, 2**64 - 59, 2**64 + 13):
+        assert is_prime(n) == True, f'FAIL: is_prime({n})'
+        assert is_prime(n + 2) == False, f'FAIL: is_prime({n+2})'
+    for n in (10201, 3215031751, 2**61 - 1, 2**64 + 13, 2**64 + 15,
+              318665857834031151167461, 2**89 - 1):
+        for a in _MR_WITNESSES:
+            assert (_miller_rabin(n, a) == _miller_rabin(n, a, pow)
+                    ), f'FAIL: _miller_rabin({n}, {a})'
+    if HAS_GMPY2:
+        # _MR_LIMIT itself is a strong pseudoprime to the first 13 primes
+        assert is_prime(_MR_LIMIT) == False, f'FAIL: is_prime({_MR_LIMIT})'
+        assert is_prime(2**89 - 1) == True, f'FAIL: is_prime({2**89 - 1})'
+    return True
+
+def _test_totient():
+    for i in range(-1, 2000):
+        assert totient(i) == totient_naive(i), f'FAIL: totient({i})'
+    for i in range(-1, 200):
+        xs, n = totient_pairs_soa(i)
+        assert [(x, n) for x in xs] == totient_pairs(i), f'FAIL: totient_pairs_soa({i})'
     return True
 
 def _test_bin():
@@ -220,6 +381,14 @@ def _test_perc():
         assert False == in_perc_range(89-i, 100, 10), f'FAIL: in_per_range: {(89-i,100,10)}'
     assert True == in_perc_range(80, 100, 20), f'FAIL: in_per_range: {(80,100,20)}'
     assert True == in_perc_range(40, 50, 20), f'FAIL: in_per_range: {(40,50,20)}'
+    assert True == in_perc_range(-90, -100, 10), f'FAIL: in_per_range: {(-90,-100,10)}'
+    assert False == in_perc_range(-89, -100, 10), f'FAIL: in_per_range: {(-89,-100,10)}'
+    assert True == in_perc_range(110, 100, 10, int), f'FAIL: in_per_range: {(110,100,10,int)}'
+    assert True == in_perc_range(-90, -100, 10, int), f'FAIL: in_per_range: {(-90,-100,10,int)}'
+    assert False == in_perc_range(-89, -100, 10, int), f'FAIL: in_per_range: {(-89,-100,10,int)}'
+    assert True == in_perc_range(1.1, 1, 10), f'FAIL: in_per_range: {(1.1,1,10)}'
+    assert True == in_perc_range(0.9, 1, 10), f'FAIL: in_per_range: {(0.9,1,10)}'
+    assert False == in_perc_range(110, 100, 19, lambda n: n // 2), f'FAIL: in_per_range: {(110,100,19)}'
     return True
 
 def _test_threshold():
@@ -253,6 +422,7 @@ def _test_eqd():
 def _run_tests():
     _test_avg() and print('Test avg: OK')
     _test_primes() and print('Test is_prime|prime_factors|prime_factors_dict|prime_factors_i: OK')
+    _test_totient() and print('Test totient: OK')
     _test_bin() and print('Test dec2bin: OK')
     _test_perc() and print('Test in_perc_range: OK')
     _test_threshold() and print('Test decimal_threshold: OK')